@@ -0,0 +1,30 @@
+
+# 虚拟设备模拟的数值计算核心
+# 对一批设备状态做纯数值计算，JSON 组装留在 virtual_device.py 中
+# 可选安装: pip install numba （安装后编译为机器码，否则使用 numpy 向量化实现）
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _step_th_loop(base_t, base_h, out, rand_t, rand_h):
+    """逐个设备计算温湿度，供 numba 编译"""
+    for i in range(base_t.shape[0]):
+        out[i, 0] = round(base_t[i] + rand_t[i], 1)
+        out[i, 1] = round(min(100.0, max(0.0, base_h[i] + rand_h[i])), 1)
+
+def _step_th_numpy(base_t, base_h, out, rand_t, rand_h):
+    """numpy 向量化实现，未安装 numba 时使用"""
+    np.round(base_t + rand_t, 1, out=out[:, 0])
+    np.round(np.clip(base_h + rand_h, 0.0, 100.0), 1, out=out[:, 1])
+
+# step_th(base_t, base_h, out, rand_t, rand_h):
+#   根据基准温湿度和随机波动计算一批温湿度传感器的读数，
+#   写入 out[:, 0]（温度，保留1位小数）和 out[:, 1]（湿度，限制在0-100，保留1位小数）
+if njit is not None:
+    step_th = njit(cache=True)(_step_th_loop)
+else:
+    step_th = _step_th_numpy
@@ -0,0 +1,41 @@
+
+# virtual_device 的测试，运行: pip install pytest && python -m pytest project1
+
+import orjson
+import pytest
+
+import virtual_device
+from virtual_device import LightSensor, MotionSensor, SmartSwitch, TemperatureHumiditySensor
+
+# 设备 ID 包含 %、引号、反斜杠和非 ASCII 字符，覆盖字节模板中的转义
+DEVICE_IDS = ["check_001", "id_100%", 'id_"quoted"', "back\\slash", "传感器_001"]
+
+@pytest.fixture
+def fixed_time(monkeypatch):
+    """固定时间戳，避免两次编码跨秒导致输出不同"""
+    monkeypatch.setattr(virtual_device, "now_iso", lambda: "2026-01-01T00:00:00")
+
+@pytest.mark.parametrize("device_class", [TemperatureHumiditySensor, LightSensor, MotionSensor, SmartSwitch])
+def test_encode_matches_generate_data(device_class, fixed_time):
+    """encode() 与 orjson.dumps(generate_data()) 输出的字节完全一致"""
+    devices = [device_class(f"{device_class.__name__}_{device_id}", None) for device_id in DEVICE_IDS]
+    for _ in range(200):
+        device_class.step_batch(devices)
+        for device in devices:
+            expected = orjson.dumps(device.generate_data())
+            actual = device.encode()
+            if actual != expected:
+                pytest.fail(f"{device.device_id}: {actual!r} != {expected!r}")
+            
+def test_encode_uses_overridden_generate_data(fixed_time):
+    """子类重写 generate_data 时，encode() 输出重写后的数据而不是字节模板"""
+    class CalibratedSensor(TemperatureHumiditySensor):
+        def generate_data(self):
+            data = super().generate_data()
+            data["data"]["calibrated"] = True
+            return data
+            
+    sensor = CalibratedSensor("calibrated_001", None)
+    encoded = sensor.encode()
+    assert encoded == orjson.dumps(sensor.generate_data())
+    assert orjson.loads(encoded)["data"]["calibrated"] is True
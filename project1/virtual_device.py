@@ -1,19 +1,269 @@
 
 # MQTT物联网虚拟设备模拟器
-# 需要安装: pip install paho-mqtt
+# 需要安装: pip install paho-mqtt orjson numpy
+# 可选安装: pip install numba （加速 sim_core 中的批量计算）
 
 import paho.mqtt.client as mqtt
-import json
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import numpy as np
+import orjson
 import time
-import random
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
+import signal
+import socket
+import sys
 import threading
+import uuid
 from datetime import datetime
 import logging
 
+from sim_core import step_th
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 批量模式下合并发送的主题和单条消息大小上限
+BATCH_TOPIC = "devices/batch"
+BATCH_MAX_BYTES = 16 * 1024
+
+# 遥测数据即发即弃：QoS 0、不保留，也不等待 wait_for_publish()，每条消息省去一次往返
+TELEMETRY_QOS = 0
+
+# 发送数据时可以处理的异常：连接/socket 错误、paho 参数错误、序列化错误
+PUBLISH_ERRORS = (OSError, ValueError, orjson.JSONEncodeError)
+
+# Broker 保留会话的时间（秒）：指定了固定 client_id 时会话可跨重启恢复，保留较久；
+# 默认 client_id 每次运行都不同，会话只用于进程内断线重连，只需覆盖最长重连间隔
+SESSION_EXPIRY_INTERVAL = 3600
+RECONNECT_SESSION_EXPIRY = 60
+
+# 停止时等待调度线程和子进程退出的最长时间（秒）
+STOP_TIMEOUT = 5
+
+# 启动时等待子进程连接 Broker 并启动设备的最长时间（秒）
+WORKER_START_TIMEOUT = 30
+
+# 随机数由 numpy 按批生成，避免每次采样都调用 random 模块
+_RNG = np.random.default_rng()
+
+_ts_cache = (0, "")
+
+def now_iso():
+    """返回当前时间的 ISO 字符串（精确到秒），同一秒内复用已格式化的结果"""
+    global _ts_cache
+    t = int(time.time())
+    cached_t, cached_iso = _ts_cache
+    if cached_t != t:
+        cached_iso = datetime.fromtimestamp(t).isoformat()
+        _ts_cache = (t, cached_iso)
+    return cached_iso
+
+class DeviceArray:
+    """设备状态的结构化数组（SoA）存储：每个字段一个 ndarray，按设备行号索引"""
+    FIELDS = {
+        "base_temp": np.float64,
+        "base_humidity": np.float64,
+        "temperature": np.float64,
+        "humidity": np.float64,
+        "light_intensity": np.float64,
+        "motion_detected": np.bool_,
+        "detection_count": np.int64,
+        "is_on": np.bool_,
+        "power_consumption": np.float64,
+    }
+    
+    def __init__(self, capacity=64):
+        self.ids = []
+        self.lock = threading.Lock()
+        for name, dtype in self.FIELDS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+            
+    def allocate(self, device_id):
+        """为设备分配一行并返回行号，容量不足时翻倍扩容"""
+        with self.lock:
+            row = len(self.ids)
+            if row == len(self.base_temp):
+                for name in self.FIELDS:
+                    column = getattr(self, name)
+                    setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+            self.ids.append(device_id)
+            return row
+            
+# 当前进程内所有虚拟设备共享的状态存储
+DEVICE_STATE = DeviceArray()
+
+def _state_field(name):
+    """设备属性：读写 DEVICE_STATE 中本设备所在行的 name 字段"""
+    def fget(self):
+        return getattr(DEVICE_STATE, name)[self._row].item()
+        
+    def fset(self, value):
+        with DEVICE_STATE.lock:
+            getattr(DEVICE_STATE, name)[self._row] = value
+            
+    return property(fget, fset)
+
+def _for_each_device(devices, action, error_message):
+    """对每个设备执行 action，出错的设备记录日志后跳过，继续处理剩余设备"""
+    for device in devices:
+        try:
+            action(device)
+        except PUBLISH_ERRORS as e:
+            logger.error(f"设备 {device.device_id} {error_message}: {e}")
+        except Exception:
+            # 设备实现中的意外错误（如子类 generate_data 抛出 KeyError）只影响该设备，其他设备继续发送
+            logger.exception(f"设备 {device.device_id} {error_message}")
+
+def _rows_of(devices):
+    """取出一组设备在 DEVICE_STATE 中的行号数组"""
+    return np.fromiter((device._row for device in devices), dtype=np.intp, count=len(devices))
+
+class DeviceScheduler:
+    """设备调度器：用一个线程按下次发送时间调度所有设备，避免每个设备占用一个线程"""
+    def __init__(self, batch=False, batch_window_ms=50):
+        self.batch = batch
+        self.batch_window = batch_window_ms / 1000 if batch else 0
+        self._heap = []  # (next_ts, seq, device) 小顶堆
+        self._seq = itertools.count()
+        # 每个已注册设备当前有效的堆条目序号；注销只删除这里的记录，堆中的旧条目在出堆时丢弃
+        self._entries = {}
+        self._cond = threading.Condition()
+        self.is_running = False
+        self.thread = None
+        
+    def add(self, device):
+        """注册设备，立即发送第一条数据；批量模式下推迟一个窗口，让同时启动的设备合并到同一批"""
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[device] = seq
+            heapq.heappush(self._heap, (time.monotonic() + self.batch_window, seq, device))
+            self._cond.notify()
+            if not self.is_running:
+                self.is_running = True
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+                
+    def remove(self, device):
+        """注销设备，O(1)：不重建堆，设备的旧条目会在出堆时被丢弃"""
+        with self._cond:
+            self._entries.pop(device, None)
+            
+    def stop(self):
+        """停止调度线程，等待中的调度循环会被立即唤醒"""
+        with self._cond:
+            self.is_running = False
+            self._cond.notify()
+        if self.thread:
+            self.thread.join(STOP_TIMEOUT)
+            if self.thread.is_alive():
+                logger.warning(f"调度线程未在 {STOP_TIMEOUT} 秒内退出")
+            
+    def _run(self):
+        """调度循环：等待最早到期的设备，发送后按固定间隔重新入堆"""
+        while True:
+            devices = self._next_due()
+            if devices is None:
+                return
+            # 在锁外推进状态和发送，stop()/add()/remove() 不必等待本周期的全部 publish()
+            try:
+                self._tick(devices)
+            except Exception:
+                # 兜底：任何意外错误都不能让调度线程退出，否则所有设备都会停止发送
+                logger.exception("调度周期处理错误")
+                
+    def _next_due(self):
+        """在锁内等待下一批到期设备，并按发送间隔重新入堆；调度器停止后返回 None"""
+        with self._cond:
+            while self.is_running:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                delay = self._heap[0][0] - now
+                if delay > 0:
+                    # 新增设备或停止时会被提前唤醒
+                    self._cond.wait(delay)
+                    continue
+                # 取出窗口内所有到期设备，全部取出后再重新入堆，避免间隔小于窗口的设备被重复取出
+                horizon = now + self.batch_window
+                due = []
+                while self._heap and self._heap[0][0] <= horizon:
+                    entry = heapq.heappop(self._heap)
+                    # 已注销或重新注册的设备，其旧条目直接丢弃
+                    if self._entries.get(entry[2]) == entry[1]:
+                        due.append(entry)
+                if not due:
+                    continue
+                for next_ts, seq, device in due:
+                    heapq.heappush(self._heap, (next_ts + device.publish_interval, seq, device))
+                return [device for _, _, device in due]
+            return None
+            
+    def _tick(self, devices):
+        """推进本周期到期设备的状态并发送数据"""
+        self._step_devices(devices)
+        if self.batch:
+            self._publish_batch(devices)
+        else:
+            # 通过实例调用，子类重写的 publish() 也会生效
+            _for_each_device(devices, operator.methodcaller("publish"), "发送数据错误")
+            
+    def _step_devices(self, devices):
+        """按设备类型分组，每组调用一次 step_batch 统一推进本周期的设备状态"""
+        groups = {}
+        for device in devices:
+            groups.setdefault(type(device), []).append(device)
+        for device_class, group in groups.items():
+            try:
+                device_class.step_batch(group)
+            except Exception:
+                # 与发送路径一致：意外错误记录完整堆栈，只跳过出错的设备类型
+                logger.exception(f"{device_class.__name__} 状态更新错误")
+                        
+    def _publish_batch(self, devices):
+        """把到期设备的数据合并为 {"batch": [...]} 发送到 BATCH_TOPIC，按客户端分组，每条不超过 BATCH_MAX_BYTES"""
+        groups = {}
+        _for_each_device(
+            devices,
+            lambda device: groups.setdefault(device.mqtt_client, []).append(device.encode()),
+            "生成数据错误",
+        )
+        
+        overhead = len(b'{"batch":[]}')
+        for client, payloads in groups.items():
+            chunk = []
+            size = overhead
+            for payload in payloads:
+                if chunk and size + len(payload) + 1 > BATCH_MAX_BYTES:
+                    self._send_batch(client, chunk)
+                    chunk = []
+                    size = overhead
+                chunk.append(payload)
+                size += len(payload) + 1
+            if chunk:
+                self._send_batch(client, chunk)
+                
+    def _send_batch(self, client, payloads):
+        """发送一条批量消息，各设备数据已是 JSON bytes，直接拼接成数组；失败只影响这一条"""
+        payload = b'{"batch":[' + b','.join(payloads) + b']}'
+        try:
+            client.publish(BATCH_TOPIC, payload, qos=TELEMETRY_QOS, retain=False)
+        except PUBLISH_ERRORS as e:
+            logger.error(f"批量发送 {len(payloads)} 条设备数据错误: {e}")
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("批量发送 %d 条设备数据 (%d 字节)", len(payloads), len(payload))
+
+# 未加入设备管理器的设备共用的调度器，所有此类设备也只占用一个调度线程
+DEFAULT_SCHEDULER = DeviceScheduler()
+
 class VirtualDevice:
     """虚拟设备基类"""
     def __init__(self, device_id, device_type, mqtt_client, publish_interval=5):
@@ -22,161 +272,261 @@ class VirtualDevice:
         self.mqtt_client = mqtt_client
         self.publish_interval = publish_interval
         self.is_running = False
-        self.thread = None
+        self.scheduler = None
+        # 设备状态保存在 DEVICE_STATE 的一行中，子类用 _state_field 访问
+        self._row = DEVICE_STATE.allocate(device_id)
+        # 主题不会变化，只构建一次
+        self._topic = f"devices/{device_type}/{device_id}/data"
+        
+    def _make_template(self, data):
+        """构建可复用的数据字典，generate_data 每次只更新其中变化的字段"""
+        return {
+            "device_id": self.device_id,
+            "device_type": self.device_type,
+            "timestamp": None,
+            "data": data
+        }
+        
+    @classmethod
+    def step_batch(cls, devices):
+        """在本周期发送前一次性推进一组同类设备的状态，默认不做处理，子类可重写为向量化实现"""
+        pass
         
     def generate_data(self):
-        """生成设备数据，子类需要重写此方法"""
+        """生成设备数据，子类需要重写此方法；返回的字典会在下次调用时被复用"""
         raise NotImplementedError
         
     def start(self):
-        """启动设备数据发送"""
+        """启动设备数据发送，未指定调度器时使用共享的 DEFAULT_SCHEDULER"""
+        if self.scheduler is None:
+            self.scheduler = DEFAULT_SCHEDULER
         self.is_running = True
-        self.thread = threading.Thread(target=self._run)
-        self.thread.daemon = True
-        self.thread.start()
+        self.scheduler.add(self)
         logger.info(f"虚拟设备 {self.device_id} 已启动")
         
     def stop(self):
         """停止设备数据发送"""
         self.is_running = False
-        if self.thread:
-            self.thread.join()
+        if self.scheduler:
+            self.scheduler.remove(self)
         logger.info(f"虚拟设备 {self.device_id} 已停止")
         
-    def _run(self):
-        """设备运行循环"""
-        while self.is_running:
-            try:
-                data = self.generate_data()
-                topic = f"devices/{self.device_type}/{self.device_id}/data"
-                payload = json.dumps(data)
-                
-                self.mqtt_client.publish(topic, payload)
-                logger.info(f"设备 {self.device_id} 发送数据: {payload}")
-                
-                time.sleep(self.publish_interval)
-            except Exception as e:
-                logger.error(f"设备 {self.device_id} 发送数据错误: {e}")
-                time.sleep(1)
+    def encode(self):
+        """生成一次设备数据并序列化为 JSON bytes"""
+        # orjson 直接返回 bytes，paho 可直接发送
+        return orjson.dumps(self.generate_data())
+        
+    def publish(self):
+        """生成并发送一次设备数据，由调度器按 publish_interval 调用，异常由调度器统一处理"""
+        payload = self.encode()
+        self.mqtt_client.publish(self._topic, payload, qos=TELEMETRY_QOS, retain=False)
+        # 每次发送都会执行，只在开启 DEBUG 时才格式化数据内容
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("设备 %s 发送数据: %s", self.device_id, payload.decode())
 
 class TemperatureHumiditySensor(VirtualDevice):
     """温湿度传感器"""
+    base_temp = _state_field("base_temp")
+    base_humidity = _state_field("base_humidity")
+    temperature = _state_field("temperature")
+    humidity = _state_field("humidity")
+    
     def __init__(self, device_id, mqtt_client, publish_interval=5):
         super().__init__(device_id, "temperature_humidity", mqtt_client, publish_interval)
         self.base_temp = 25.0
         self.base_humidity = 60.0
+        self.temperature = self.base_temp
+        self.humidity = self.base_humidity
+        self._tpl = self._make_template({
+            "temperature": 0.0,
+            "humidity": 0.0,
+            "unit_temp": "°C",
+            "unit_humidity": "%"
+        })
+        # 与 generate_data 输出相同的 JSON 字节模板，只有时间戳和两个读数会变化
+        self._json_tpl = (
+            b'{"device_id":' + orjson.dumps(device_id).replace(b"%", b"%%")
+            + b',"device_type":' + orjson.dumps(self.device_type)
+            + b',"timestamp":"%s","data":{"temperature":%.1f,"humidity":%.1f,'
+            + '"unit_temp":"°C","unit_humidity":"%%"}}'.encode()
+        )
         
+    @classmethod
+    def step_batch(cls, sensors):
+        """模拟温度和湿度的缓慢变化，整批读数由 sim_core.step_th 计算"""
+        rows = _rows_of(sensors)
+        n = len(rows)
+        state = DEVICE_STATE
+        with state.lock:
+            out = np.empty((n, 2))
+            step_th(state.base_temp[rows], state.base_humidity[rows], out,
+                    _RNG.uniform(-2, 2, n), _RNG.uniform(-5, 5, n))
+            state.temperature[rows] = out[:, 0]
+            state.humidity[rows] = out[:, 1]
+            
     def generate_data(self):
-        # 模拟温度和湿度的缓慢变化
-        temp_variation = random.uniform(-2, 2)
-        humidity_variation = random.uniform(-5, 5)
-        
-        temperature = round(self.base_temp + temp_variation, 1)
-        humidity = round(max(0, min(100, self.base_humidity + humidity_variation)), 1)
+        # 温湿度读数已由 step_batch 在本周期计算
+        d = self._tpl
+        d["timestamp"] = now_iso()
+        d["data"]["temperature"] = self.temperature
+        d["data"]["humidity"] = self.humidity
+        return d
         
-        return {
-            "device_id": self.device_id,
-            "device_type": self.device_type,
-            "timestamp": datetime.now().isoformat(),
-            "data": {
-                "temperature": temperature,
-                "humidity": humidity,
-                "unit_temp": "°C",
-                "unit_humidity": "%"
-            }
-        }
+    def encode(self):
+        """直接填充 JSON 字节模板，跳过构建字典和 orjson 序列化"""
+        # 子类重写了 generate_data 时模板与其输出不一致，改为序列化 generate_data 的结果
+        if type(self).generate_data is not TemperatureHumiditySensor.generate_data:
+            return super().encode()
+        return self._json_tpl % (now_iso().encode(), self.temperature, self.humidity)
 
 class LightSensor(VirtualDevice):
     """光照传感器"""
+    light_intensity = _state_field("light_intensity")
+    
     def __init__(self, device_id, mqtt_client, publish_interval=5):
         super().__init__(device_id, "light", mqtt_client, publish_interval)
+        self._tpl = self._make_template({
+            "light_intensity": 0.0,
+            "unit": "lux"
+        })
         
-    def generate_data(self):
-        # 模拟光照强度（0-1000 lux）
-        current_hour = datetime.now().hour
+    @classmethod
+    def step_batch(cls, sensors):
+        """模拟光照强度（0-1000 lux），同一周期内的传感器共用当前小时"""
+        rows = _rows_of(sensors)
+        n = len(rows)
+        current_hour = int(now_iso()[11:13])  # YYYY-MM-DDTHH:MM:SS
         if 6 <= current_hour <= 18:  # 白天
-            base_light = 500 + random.uniform(-200, 300)
+            base_light = 500 + _RNG.uniform(-200, 300, n)
         else:  # 夜晚
-            base_light = 50 + random.uniform(-30, 50)
+            base_light = 50 + _RNG.uniform(-30, 50, n)
             
-        light_intensity = max(0, round(base_light, 1))
-        
-        return {
-            "device_id": self.device_id,
-            "device_type": self.device_type,
-            "timestamp": datetime.now().isoformat(),
-            "data": {
-                "light_intensity": light_intensity,
-                "unit": "lux"
-            }
-        }
+        with DEVICE_STATE.lock:
+            DEVICE_STATE.light_intensity[rows] = np.maximum(0, np.round(base_light, 1))
+            
+    def generate_data(self):
+        # 光照强度已由 step_batch 在本周期计算
+        d = self._tpl
+        d["timestamp"] = now_iso()
+        d["data"]["light_intensity"] = self.light_intensity
+        return d
 
 class MotionSensor(VirtualDevice):
     """运动传感器"""
+    motion_detected = _state_field("motion_detected")
+    detection_count = _state_field("detection_count")
+    
     def __init__(self, device_id, mqtt_client, publish_interval=10):
         super().__init__(device_id, "motion", mqtt_client, publish_interval)
+        self._tpl = self._make_template({
+            "motion_detected": False,
+            "detection_count": 0
+        })
         
+    @classmethod
+    def step_batch(cls, sensors):
+        """随机生成运动检测"""
+        rows = _rows_of(sensors)
+        n = len(rows)
+        motion_detected = _RNG.integers(0, 2, n) == 1
+        with DEVICE_STATE.lock:
+            DEVICE_STATE.motion_detected[rows] = motion_detected
+            DEVICE_STATE.detection_count[rows] = np.where(motion_detected, _RNG.integers(0, 6, n), 0)
+            
     def generate_data(self):
-        # 随机生成运动检测
-        motion_detected = random.choice([True, False])
-        
-        return {
-            "device_id": self.device_id,
-            "device_type": self.device_type,
-            "timestamp": datetime.now().isoformat(),
-            "data": {
-                "motion_detected": motion_detected,
-                "detection_count": random.randint(0, 5) if motion_detected else 0
-            }
-        }
+        # 运动检测结果已由 step_batch 在本周期生成
+        d = self._tpl
+        d["timestamp"] = now_iso()
+        d["data"]["motion_detected"] = self.motion_detected
+        d["data"]["detection_count"] = self.detection_count
+        return d
 
 class SmartSwitch(VirtualDevice):
     """智能开关"""
+    is_on = _state_field("is_on")
+    power_consumption = _state_field("power_consumption")
+    
     def __init__(self, device_id, mqtt_client, publish_interval=30):
         super().__init__(device_id, "smart_switch", mqtt_client, publish_interval)
         self.is_on = False
         self.power_consumption = 0.0
+        self._tpl = self._make_template({
+            "switch_state": "OFF",
+            "power_consumption": 0.0,
+            "unit": "W"
+        })
         
-    def generate_data(self):
-        # 随机切换开关状态
-        if random.random() < 0.1:  # 10%概率改变状态
-            self.is_on = not self.is_on
+    @classmethod
+    def step_batch(cls, switches):
+        """用一次向量化计算推进所有到期开关的状态"""
+        rows = _rows_of(switches)
+        n = len(rows)
+        with DEVICE_STATE.lock:
+            # 随机切换开关状态，10%概率改变状态
+            states = DEVICE_STATE.is_on[rows] ^ (_RNG.random(n) < 0.1)
+            DEVICE_STATE.is_on[rows] = states
+            # 计算功耗
+            DEVICE_STATE.power_consumption[rows] = np.where(states, np.round(_RNG.uniform(5, 100, n), 2), 0.0)
             
-        # 计算功耗
-        if self.is_on:
-            self.power_consumption = round(random.uniform(5, 100), 2)
-        else:
-            self.power_consumption = 0.0
-            
-        return {
-            "device_id": self.device_id,
-            "device_type": self.device_type,
-            "timestamp": datetime.now().isoformat(),
-            "data": {
-                "switch_state": "ON" if self.is_on else "OFF",
-                "power_consumption": self.power_consumption,
-                "unit": "W"
-            }
-        }
+    def generate_data(self):
+        # 开关状态已由 step_batch 在本周期推进
+        d = self._tpl
+        d["timestamp"] = now_iso()
+        d["data"]["switch_state"] = "ON" if self.is_on else "OFF"
+        d["data"]["power_consumption"] = self.power_consumption
+        return d
 
 class MQTTVirtualDeviceManager:
     """MQTT虚拟设备管理器"""
-    def __init__(self, broker_host="localhost", broker_port=1883, username=None, password=None):
+    # 批量模式下合并到期设备数据的时间窗口
+    batch_window_ms = 50
+    # 设备数超过该值时按 CPU 核数分片到多个子进程，每个子进程使用独立的MQTT连接
+    multiprocess_threshold = 500
+    
+    def __init__(self, broker_host="localhost", broker_port=1883, username=None, password=None, batch=False,
+                 client_id=None, num_clients=1, subscribe_control=True):
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.username = username
         self.password = password
-        self.client = mqtt.Client()
+        self.batch = batch
+        # 分片模式下只有主进程订阅控制主题，子进程只负责发送
+        self.subscribe_control = subscribe_control
+        # 跨重启恢复会话需要固定的 client_id；未指定时随机生成（pid 在容器中常常相同，不能用作 ID），
+        # 只在本次运行的断线重连中保留会话
+        self.persistent_session = client_id is not None
+        self.client_id = client_id or f"virtual-device-{uuid.uuid4().hex[:12]}"
+        self.session_expiry = SESSION_EXPIRY_INTERVAL if self.persistent_session else RECONNECT_SESSION_EXPIRY
+        # 多个客户端各自占用一条 TCP 连接和一个网络线程，设备轮流分配到各个客户端
+        self.num_clients = num_clients
+        if num_clients == 1:
+            client_ids = [self.client_id]
+        else:
+            client_ids = [f"{self.client_id}-{i}" for i in range(num_clients)]
+        self.clients = [
+            mqtt.Client(client_id=cid, transport="tcp", protocol=mqtt.MQTTv5) for cid in client_ids
+        ]
+        # 主客户端，负责订阅控制主题
+        self.client = self.clients[0]
         self.devices = []
+        self.scheduler = DeviceScheduler(batch=batch, batch_window_ms=self.batch_window_ms)
+        self.workers = []
+        self._workers_stop = None
+        self._failed_workers = set()
         self.setup_mqtt()
         
     def setup_mqtt(self):
         """设置MQTT客户端"""
-        def on_connect(client, userdata, flags, rc):
+        def on_connect(client, userdata, flags, rc, properties=None):
             if rc == 0:
                 logger.info(f"成功连接到MQTT Broker: {self.broker_host}:{self.broker_port}")
-                # 订阅控制主题
-                client.subscribe("devices/+/+/control")
+                # 遥测消息小而频繁，关闭 Nagle 算法避免合并等待；每次重连都是新 socket，需要重新设置
+                sock = client.socket()
+                if sock:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # 订阅控制主题，只由主进程的主客户端订阅，避免同一条命令被处理多次
+                if self.subscribe_control and client is self.client:
+                    client.subscribe("devices/+/+/control")
             else:
                 logger.error(f"连接MQTT Broker失败，错误代码: {rc}")
                 
@@ -185,55 +535,172 @@ class MQTTVirtualDeviceManager:
                 topic_parts = msg.topic.split('/')
                 device_type = topic_parts[1]
                 device_id = topic_parts[2]
-                command = json.loads(msg.payload.decode())
-                logger.info(f"收到设备控制命令: {device_type}/{device_id} -> {command}")
+                # orjson 可直接解析 bytes，省去 decode
+                command = orjson.loads(msg.payload)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("收到设备控制命令: %s/%s -> %s", device_type, device_id, command)
                 # 这里可以添加设备控制逻辑
             except Exception as e:
                 logger.error(f"处理控制命令错误: {e}")
                 
-        def on_disconnect(client, userdata, rc):
+        def on_disconnect(client, userdata, rc, properties=None):
             logger.warning(f"与MQTT Broker断开连接，错误代码: {rc}")
             
-        self.client.on_connect = on_connect
-        self.client.on_message = on_message
-        self.client.on_disconnect = on_disconnect
-        
-        if self.username and self.password:
-            self.client.username_pw_set(self.username, self.password)
+        for client in self.clients:
+            client.on_connect = on_connect
+            client.on_message = on_message
+            client.on_disconnect = on_disconnect
+            # 取消单连接的飞行窗口和发送队列限制
+            client.max_inflight_messages_set(65535)
+            client.max_queued_messages_set(0)
+            # 指数退避重连，避免大量客户端同时重连
+            client.reconnect_delay_set(min_delay=1, max_delay=16)
+            
+            if self.username and self.password:
+                client.username_pw_set(self.username, self.password)
             
     def connect(self):
         """连接到MQTT Broker"""
         try:
-            self.client.connect(self.broker_host, self.broker_port, 60)
-            self.client.loop_start()
+            # MQTT v5 没有 clean_session，用 clean_start 加会话过期时间让 Broker 在重连时保留会话：
+            # 固定 client_id 首次连接也恢复旧会话；随机 client_id 首次连接清空会话，只在之后的重连中保留
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.session_expiry
+            clean_start = False if self.persistent_session else mqtt.MQTT_CLEAN_START_FIRST_ONLY
+            for client in self.clients:
+                client.connect(self.broker_host, self.broker_port, 60, clean_start=clean_start,
+                               properties=properties)
+                client.loop_start()
             return True
         except Exception as e:
             logger.error(f"连接MQTT Broker失败: {e}")
             return False
             
     def add_device(self, device):
-        """添加虚拟设备"""
+        """添加虚拟设备，按添加顺序轮流分配到各个MQTT客户端"""
+        device.mqtt_client = self.clients[len(self.devices) % self.num_clients]
+        device.scheduler = self.scheduler
         self.devices.append(device)
         logger.info(f"添加虚拟设备: {device.device_id}")
         
     def start_all_devices(self):
-        """启动所有虚拟设备"""
+        """启动所有虚拟设备，设备数超过 multiprocess_threshold 时分片到多个子进程运行"""
+        if len(self.devices) > self.multiprocess_threshold:
+            started = self._start_workers(os.cpu_count() or 1)
+        else:
+            for device in self.devices:
+                device.start()
+            started = len(self.devices)
+        if started == len(self.devices):
+            logger.info(f"所有 {started} 个虚拟设备已启动")
+        else:
+            logger.error(f"只有 {started}/{len(self.devices)} 个虚拟设备已启动")
+        
+    def _start_workers(self, num_workers):
+        """按 device_id 哈希把设备分片，每个子进程重建自己的设备并独立连接 Broker，返回已启动的设备数"""
+        ctx = multiprocessing.get_context("spawn")
+        self._workers_stop = ctx.Event()
+        shards = [[] for _ in range(num_workers)]
         for device in self.devices:
-            device.start()
-        logger.info(f"所有 {len(self.devices)} 个虚拟设备已启动")
+            config = (type(device), device.device_id, device.publish_interval)
+            shards[hash(device.device_id) % num_workers].append(config)
+            
+        ready_events = []
+        # 启动期间临时忽略 SIGINT，子进程继承该设置，从解释器启动、导入模块起就不会被 Ctrl+C 打断
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        if in_main_thread:
+            previous_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            for index, configs in enumerate(shards):
+                # 固定 client_id 加分片序号，子进程的会话同样可以跨重启恢复
+                worker_client_id = f"{self.client_id}-w{index}" if self.persistent_session else None
+                ready = ctx.Event()
+                worker = ctx.Process(
+                    target=_device_worker,
+                    args=(self.broker_host, self.broker_port, self.username, self.password,
+                          self.batch, worker_client_id, self.num_clients, configs, self._workers_stop, ready),
+                    daemon=True,
+                )
+                worker.start()
+                self.workers.append(worker)
+                ready_events.append(ready)
+        finally:
+            if in_main_thread:
+                signal.signal(signal.SIGINT, previous_handler)
+            
+        # 等待各子进程连接 Broker 并启动设备；连接失败的子进程以非零退出码结束
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        started = 0
+        for index, (worker, ready) in enumerate(zip(self.workers, ready_events)):
+            while not ready.wait(0.1):
+                if not worker.is_alive() or time.monotonic() > deadline:
+                    break
+            if ready.is_set():
+                started += len(shards[index])
+            elif worker.is_alive():
+                logger.warning(f"设备子进程 {index} (pid {worker.pid}) 未在 {WORKER_START_TIMEOUT} 秒内启动完成")
+            else:
+                self._failed_workers.add(index)
+                logger.error(f"设备子进程 {index} 启动失败，退出码 {worker.exitcode}，"
+                             f"{len(shards[index])} 个设备未运行")
+        logger.info(f"已启动 {num_workers - len(self._failed_workers)}/{num_workers} 个设备子进程")
+        return started
+        
+    def check_workers(self):
+        """检查设备子进程是否意外退出，每个退出的子进程只记录一次，返回仍在运行的子进程数"""
+        alive = 0
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive():
+                alive += 1
+            elif index not in self._failed_workers:
+                self._failed_workers.add(index)
+                logger.error(f"设备子进程 {index} (pid {worker.pid}) 意外退出，退出码 {worker.exitcode}")
+        return alive
         
     def stop_all_devices(self):
         """停止所有虚拟设备"""
+        if self.workers:
+            self._workers_stop.set()
+            for worker in self.workers:
+                worker.join(STOP_TIMEOUT)
+                if worker.is_alive():
+                    logger.warning(f"设备子进程 {worker.pid} 未在 {STOP_TIMEOUT} 秒内退出，强制结束")
+                    worker.terminate()
+            self.workers = []
+            self._failed_workers.clear()
         for device in self.devices:
             device.stop()
+        self.scheduler.stop()
         logger.info("所有虚拟设备已停止")
         
     def disconnect(self):
         """断开MQTT连接"""
-        self.client.loop_stop()
-        self.client.disconnect()
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
         logger.info("已断开MQTT连接")
 
+def _device_worker(broker_host, broker_port, username, password, batch, client_id, num_clients, configs,
+                   stop_event, ready_event):
+    """设备子进程：按设备配置重建设备，使用自己的MQTT客户端运行分到的设备；连接失败时以退出码 1 结束"""
+    # Ctrl+C 会同时发给子进程，由主进程统一通知停止；子进程忽略 SIGINT，连接或启动设备时也不会打印堆栈
+    # （主进程在主线程中启动子进程时已让子进程继承该设置，这里覆盖从其他线程启动的情况）
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    manager = MQTTVirtualDeviceManager(broker_host, broker_port, username, password, batch,
+                                       client_id=client_id, num_clients=num_clients, subscribe_control=False)
+    if not manager.connect():
+        sys.exit(1)
+        
+    for device_class, device_id, publish_interval in configs:
+        manager.add_device(device_class(device_id, manager.client, publish_interval))
+    for device in manager.devices:
+        device.start()
+    ready_event.set()
+    
+    stop_event.wait()
+    manager.stop_all_devices()
+    manager.disconnect()
+
 def main():
     """主函数"""
     # 创建设备管理器
@@ -242,7 +709,10 @@ def main():
         broker_host="localhost",  # 或者使用 "test.mosquitto.org" 作为测试
         broker_port=1883,
         # username="your_username",
-        # password="your_password"
+        # password="your_password",
+        # batch=True,  # 合并到期设备数据，统一发送到 devices/batch
+        # num_clients=4,  # 使用多条MQTT连接并行发送
+        # client_id="my-simulator",  # 固定 client_id，重启后可恢复 Broker 上的会话
     )
     
     # 连接到MQTT broker
@@ -272,9 +742,10 @@ def main():
         print("虚拟设备正在运行...")
         print("按 Ctrl+C 停止所有设备")
         
-        # 保持程序运行
+        # 保持程序运行，定期检查设备子进程是否意外退出
         while True:
             time.sleep(1)
+            manager.check_workers()
             
     except KeyboardInterrupt:
         print("\n正在停止所有设备...")